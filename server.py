@@ -4,34 +4,189 @@
 import asyncio
 import websockets
 import json
-import base64
 import cv2
 import pyrealsense2 as rs
 import numpy as np
 from datetime import datetime
 import os
+import re
+import shutil
+import subprocess
 from threading import Thread, Lock
 import time
 import sounddevice as sd
 import wave
 import queue
 
+try:
+    import uvloop  # Optional: faster event loop for the WebSocket side
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson  # Optional: faster JSON for the per-frame message header
+except ImportError:
+    orjson = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420  # Optional: faster preview JPEG encoding
+except ImportError:
+    TurboJPEG = None
+
+class RecordRing:
+    """Bounded pool of frame slots handed from the capture thread to a writer thread"""
+    def __init__(self, size, layouts):
+        self.size = size
+        self.layouts = layouts  # (shape, dtype) of each array in a slot
+        self.allocated = 0
+        self.free_slots = queue.Queue()
+        self.ready_slots = queue.Queue()
+    
+    def acquire(self):
+        """Get a slot to fill, dropping the oldest unwritten frame if the writer is behind"""
+        try:
+            return self.free_slots.get_nowait()
+        except queue.Empty:
+            pass
+        
+        # Allocate lazily, so a writer that keeps up only ever uses a slot or two
+        if self.allocated < self.size:
+            self.allocated += 1
+            return tuple(np.empty(shape, dtype) for shape, dtype in self.layouts)
+        
+        try:
+            slot = self.ready_slots.get_nowait()
+        except queue.Empty:
+            return None  # Writer holds every slot
+        if slot is None:
+            self.ready_slots.put(None)  # Leave the stop sentinel for the writer
+        return slot
+
+# Per ffmpeg encoder: (arguments before the input, arguments before the output).
+# Tuned for low latency: fastest preset and no B-frames, so frames are never held back
+FFMPEG_ENCODER_ARGS = {
+    'h264_nvenc': ([], ['-preset', 'p1', '-tune', 'll', '-bf', '0']),
+    'h264_vaapi': (['-vaapi_device', '/dev/dri/renderD128'], ['-vf', 'format=nv12,hwupload', '-bf', '0']),
+    # Software H.264 without a GPU; still far cheaper than mp4v at these settings
+    'libx264': ([], ['-preset', 'ultrafast', '-tune', 'zerolatency', '-bf', '0', '-pix_fmt', 'yuv420p']),
+}
+
+class FFmpegWriter:
+    """cv2.VideoWriter look-alike that pipes raw BGR frames into an ffmpeg encoder process"""
+    def __init__(self, filename, encoder, fps, size):
+        self.filename = filename
+        self.encoder = encoder
+        self.fps = fps
+        self.size = size
+        width, height = size
+        input_args, output_args = FFMPEG_ENCODER_ARGS[encoder]
+        command = ['ffmpeg', '-y', '-loglevel', 'error'] + input_args
+        command += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}',
+                    '-r', str(fps), '-i', '-']
+        command += ['-c:v', encoder] + output_args + [filename]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    
+    def isOpened(self):
+        # Only catches a failed launch; an encoder that dies later surfaces as an OSError from write()
+        return self.process.poll() is None
+    
+    def write(self, frame):
+        # Slots are contiguous, so the frame memory goes to the pipe without a tobytes() copy
+        self.process.stdin.write(memoryview(frame))
+    
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass  # ffmpeg already exited; nothing left to flush
+        self.process.wait()
+
+class DepthNpyWriter:
+    """Append raw depth frames to a .npy file as they arrive; the header gets the final count on release"""
+    HEADER_SIZE = 128  # Fixed .npy v1.0 header size, large enough for any frame count
+    
+    def __init__(self, filename, shape, dtype=np.uint16):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.file = open(filename, 'wb')
+        self.file.write(self.header())  # Placeholder until the frame count is known
+    
+    def header(self):
+        description = str({
+            'descr': self.dtype.str,
+            'fortran_order': False,
+            'shape': (self.count,) + tuple(self.shape),
+        })
+        padding = self.HEADER_SIZE - 10 - len(description) - 1
+        return (b'\x93NUMPY\x01\x00' + (self.HEADER_SIZE - 10).to_bytes(2, 'little')
+                + description.encode('latin1') + b' ' * padding + b'\n')
+    
+    def write(self, frame):
+        self.file.write(memoryview(frame))
+        self.count += 1
+    
+    def release(self):
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
 class GridCameraRealSenseServer:
-    def __init__(self):
+    def __init__(self, preview_size=(320, 240), preview_quality=70, record_depth_raw=False):
         self.pipelines = []
+        self.frame_queues = []  # Per camera rs.frame_queue the pipeline delivers framesets into
         self.configs = []
         self.camera_serials = []
         self.is_streaming = False
         self.is_recording = False
         self.video_writers = []
         self.rgb_writers = []
-        self.depth_arrays = []
+        # Raw z16 depth to depth.npy is opt-in: ~18 MB/s per camera, written on its own thread
+        # so a slow disk only drops raw depth frames, never video frames
+        self.record_depth_raw = record_depth_raw
+        self.depth_npy_writers = []
+        self.depth_raw_rings = []  # Per camera RecordRing for raw depth, with its own writer thread
         self.depth_writers = []  # Add depth video writers
         self.camera_dirs = []
         self.session_dir = None
+        self.record_rings = []  # Per camera RecordRing shared with its writer thread
+        self.record_threads = []
+        self.record_ring_size = 8
+        self.finish_threads = []  # Sessions still being finalized after stop_recording
+        
+        # Video encoding: GStreamer hardware H.264 encoders tried before software mp4v
+        self.has_gstreamer = re.search(r"GStreamer:\s*YES", cv2.getBuildInformation()) is not None
+        self.hw_encoders = ['nvh264enc preset=low-latency-hq', 'vaapih264enc', 'v4l2h264enc']
+        # Then GPU encoders (and x264) through an ffmpeg subprocess fed with raw frames
+        self.has_ffmpeg = shutil.which('ffmpeg') is not None
+        self.ffmpeg_encoders = list(FFMPEG_ENCODER_ARGS)
+        self.video_encoder = None  # Probed once in start_server, then reused
         self.frame_lock = Lock()
+        self.frame_buffers = []  # Per camera, reused by every capture iteration
         self.latest_frames = {}
+        self.camera_frames = []  # Latest frame per camera index, None while it is timing out
+        self.fresh_cameras = set()  # Cameras that reported since the last broadcaster wake-up
         self.connected_clients = set()
+        self.depth_raw_clients = set()  # Clients that asked for lossless z16 depth as well
+        # Browser preview is downscaled and encoded cheaper; recording keeps full resolution
+        self.preview_size = preview_size  # (width, height)
+        self.preview_quality = preview_quality
+        # Backpressure: clients with this much unsent data skip frames (raw depth subscribers
+        # get one raw frame set on top). The preview quality follows a moving average of the
+        # preview clients' backlog, adjusted about once a second
+        self.max_client_backlog = 256 * 1024
+        self.min_preview_quality = 40
+        self.jpeg_quality = preview_quality
+        self.preview_backlog = 0.0  # Moving average of the worst preview-only client's backlog, bytes
+        self.quality_adjusted_at = 0.0
+        self.turbojpeg = None
+        if TurboJPEG is not None:
+            try:
+                self.turbojpeg = TurboJPEG()
+            except Exception as e:
+                print(f"TurboJPEG unavailable, using OpenCV JPEG encoder: {e}")
+        self.loop = None  # Event loop running the broadcaster, set in start_server
+        self.new_frame_event = None  # Set from the capture thread when new frames are published
         self.frame_count = 0
         self.recordings_dir = "recordings"
         
@@ -58,11 +213,17 @@ class GridCameraRealSenseServer:
         
         print(f"Found {len(devices)} RealSense camera(s):")
         
+        # Look the info enums up once instead of per device
+        info_serial = rs.camera_info.serial_number
+        info_name = rs.camera_info.name
+        info_firmware = rs.camera_info.firmware_version
+        
         camera_info = []
         for i, device in enumerate(devices):
-            serial = device.get_info(rs.camera_info.serial_number)
-            name = device.get_info(rs.camera_info.name)
-            firmware = device.get_info(rs.camera_info.firmware_version)
+            serial = device.get_info(info_serial)
+            name = device.get_info(info_name)
+            # get_info raises for fields a device does not report, so check first
+            firmware = device.get_info(info_firmware) if device.supports(info_firmware) else 'n/a'
             
             camera_info.append({
                 'index': i,
@@ -94,11 +255,20 @@ class GridCameraRealSenseServer:
                 config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
                 config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
                 
-                # Start pipeline
-                pipeline.start(config)
+                # Start pipeline into a 1-frameset queue: librealsense drops stale framesets
+                # and capture always gets the newest one
+                frame_queue = rs.frame_queue(1, keep_frames=False)
+                profile = pipeline.start(config, frame_queue)
+                
+                # Keep at most 2 frames queued per sensor so a slow consumer sees fresh
+                # frames instead of a backlog of stale ones
+                for sensor in profile.get_device().query_sensors():
+                    if sensor.supports(rs.option.frames_queue_size):
+                        sensor.set_option(rs.option.frames_queue_size, 2)
                 
                 # Store pipeline info
                 self.pipelines.append(pipeline)
+                self.frame_queues.append(frame_queue)
                 self.configs.append(config)
                 self.camera_serials.append(cam['serial'])
                 
@@ -113,9 +283,24 @@ class GridCameraRealSenseServer:
         
         print(f"\nSuccessfully initialized {len(self.pipelines)} camera(s)")
         
+        self.allocate_frame_buffers()
+        
         # Initialize audio
         self.initialize_audio()
         
+    def allocate_frame_buffers(self):
+        """Allocate per-camera frame buffers once instead of every captured frame"""
+        self.frame_buffers = []
+        for _ in self.pipelines:
+            # Color and raw depth are read in place from the rs frames; nothing published
+            # refers to these buffers (raw depth goes out as a copy, recording copies into ring slots)
+            self.frame_buffers.append({
+                'depth_u8': np.empty((480, 640), np.uint8),
+                'depth_colormap': np.empty((480, 640, 3), np.uint8),
+                'color_preview': np.empty((self.preview_size[1], self.preview_size[0], 3), np.uint8),
+                'depth_preview': np.empty((self.preview_size[1], self.preview_size[0], 3), np.uint8)
+            })
+    
     def initialize_audio(self):
         """Initialize system audio capture"""
         try:
@@ -160,99 +345,270 @@ class GridCameraRealSenseServer:
         except Exception as e:
             print(f"Audio capture error: {e}")
         
-    def capture_frames(self):
-        """Continuously capture RGB + Depth frames from all cameras"""
-        print("Starting frame capture thread...")
-        timeout_counts = [0] * len(self.pipelines)
+    def capture_frames(self, i):
+        """Continuously capture RGB + Depth frames from one camera"""
+        print(f"Starting frame capture thread for camera {i}...")
+        frame_queue = self.frame_queues[i]
+        timeout_count = 0
         
         while self.is_streaming:
-            frame_data = {}
-            
-            for i, pipeline in enumerate(self.pipelines):
-                try:
-                    # Wait for frames
-                    frames = pipeline.wait_for_frames(timeout_ms=1000)
-                    color_frame = frames.get_color_frame()
-                    depth_frame = frames.get_depth_frame()
-                    
-                    if not color_frame or not depth_frame:
-                        continue
-                    
-                    # Convert to numpy arrays
-                    color_image = np.asanyarray(color_frame.get_data())
-                    depth_image = np.asanyarray(depth_frame.get_data())
+            try:
+                # Wait for frames; each camera waits in its own thread so the waits overlap
+                frames = frame_queue.wait_for_frame(1000).as_frameset()
+                color_frame = frames.get_color_frame()
+                depth_frame = frames.get_depth_frame()
+                
+                if not color_frame or not depth_frame:
+                    continue
+                
+                # Nothing to compute for the grid or the recorder while neither is active
+                record_rings = self.record_rings
+                depth_raw_rings = self.depth_raw_rings
+                need_stream = bool(self.connected_clients)
+                need_record = self.is_recording and i < len(record_rings)
+                color_jpeg = depth_jpeg = None
+                
+                if need_stream or need_record:
+                    # Zero-copy views over the rs frames, valid until the next wait_for_frame;
+                    # everything that outlives this iteration copies out of them below
+                    buffers = self.frame_buffers[i]
+                    color_image = np.frombuffer(color_frame.get_data(), dtype=np.uint8).reshape(480, 640, 3)
+                    depth_image = np.frombuffer(depth_frame.get_data(), dtype=np.uint16).reshape(480, 640)
                     
                     # Apply colormap on depth image (from official_minimal_stream.py)
-                    depth_colormap = cv2.applyColorMap(
-                        cv2.convertScaleAbs(depth_image, alpha=0.03), 
-                        cv2.COLORMAP_JET
-                    )
-                    
-                    # Encode both as JPEG
-                    _, color_buffer = cv2.imencode('.jpg', color_image, 
-                                                 [cv2.IMWRITE_JPEG_QUALITY, 90])
-                    color_base64 = base64.b64encode(color_buffer).decode('utf-8')
-                    
-                    _, depth_buffer = cv2.imencode('.jpg', depth_colormap, 
-                                                 [cv2.IMWRITE_JPEG_QUALITY, 90])
-                    depth_base64 = base64.b64encode(depth_buffer).decode('utf-8')
-                    
-                    frame_data[f'cam{i}'] = {
-                        'color_image': color_image,
-                        'depth_image': depth_image,
-                        'color_encoded': color_base64,
-                        'depth_encoded': depth_base64,
-                        'timestamp': time.time(),
-                        'serial': self.camera_serials[i]
-                    }
-                    
-                    # Record if enabled - save RGB, Depth, and Combined
-                    if self.is_recording and i < len(self.video_writers):
-                        # 1. Save RGB video
-                        if i < len(self.rgb_writers) and self.rgb_writers[i]:
-                            self.rgb_writers[i].write(color_image)
-                        
-                        # 2. Save depth video (colormap)
-                        if i < len(self.depth_writers) and self.depth_writers[i]:
-                            self.depth_writers[i].write(depth_colormap)
-                        
-                        # 3. Save combined side-by-side video
-                        if self.video_writers[i]:
-                            depth_colormap_dim = depth_colormap.shape
-                            color_colormap_dim = color_image.shape
-                            
-                            if depth_colormap_dim != color_colormap_dim:
-                                resized_color_image = cv2.resize(
-                                    color_image, 
-                                    dsize=(depth_colormap_dim[1], depth_colormap_dim[0]), 
-                                    interpolation=cv2.INTER_AREA
-                                )
-                                combined_image = np.hstack((resized_color_image, depth_colormap))
-                            else:
-                                combined_image = np.hstack((color_image, depth_colormap))
-                            
-                            self.video_writers[i].write(combined_image)
+                    depth_colormap = buffers['depth_colormap']
+                    cv2.convertScaleAbs(depth_image, buffers['depth_u8'], alpha=0.03)
+                    cv2.applyColorMap(buffers['depth_u8'], cv2.COLORMAP_JET, depth_colormap)
+                
+                # Encode downscaled previews as JPEG (sent as raw bytes, no base64),
+                # only if someone is watching
+                if need_stream:
+                    cv2.resize(color_image, self.preview_size, buffers['color_preview'],
+                               interpolation=cv2.INTER_AREA)
+                    cv2.resize(depth_colormap, self.preview_size, buffers['depth_preview'],
+                               interpolation=cv2.INTER_AREA)
                     
-                    # Reset timeout counter on success
-                    timeout_counts[i] = 0
+                    color_jpeg = self.encode_jpeg(buffers['color_preview'])
+                    depth_jpeg = self.encode_jpeg(buffers['depth_preview'])
+                
+                frame_data = {
+                    'color_jpeg': color_jpeg,
+                    'depth_jpeg': depth_jpeg,
+                    # Lossless depth for subscribed clients (copied, the rs frame goes back to librealsense)
+                    'depth_raw': depth_image.tobytes() if need_stream and self.depth_raw_clients else None,
+                    # Host monotonic clock: shared by all cameras and never jumps, unlike time.time()
+                    # or the per-device hardware clocks
+                    'timestamp': time.monotonic_ns(),
+                    'serial': self.camera_serials[i]
+                }
+                
+                # Record if enabled - hand a copy to this camera's writer thread
+                if need_record:
+                    slot = record_rings[i].acquire()
+                    if slot is not None:
+                        color_slot, depth_slot = slot
+                        np.copyto(color_slot, color_image)
+                        np.copyto(depth_slot, depth_colormap)
+                        record_rings[i].ready_slots.put(slot)
                     
-                except RuntimeError as e:
-                    timeout_counts[i] += 1
-                    if timeout_counts[i] % 20 == 1:
-                        print(f"Camera {i} timeout #{timeout_counts[i]}: {e}")
-                    continue
-                except Exception as e:
-                    print(f"Camera {i} capture error: {e}")
-                    continue
+                    if i < len(depth_raw_rings):
+                        slot = depth_raw_rings[i].acquire()
+                        if slot is not None:
+                            np.copyto(slot[0], depth_image)
+                            depth_raw_rings[i].ready_slots.put(slot)
+                
+                # Reset timeout counter on success
+                timeout_count = 0
+                
+            except RuntimeError as e:
+                timeout_count += 1
+                if timeout_count % 20 == 1:
+                    print(f"Camera {i} timeout #{timeout_count}: {e}")
+                frame_data = None  # Drop this camera from the grid until it recovers
+            except Exception as e:
+                print(f"Camera {i} capture error: {e}")
+                continue
+            
+            # No sleep needed: wait_for_frames blocks until the camera delivers, which paces this loop
+            self.publish_frame(i, frame_data)
+    
+    def encode_jpeg(self, image):
+        """Encode a BGR preview image as JPEG, with libjpeg-turbo when available"""
+        if self.turbojpeg is not None:
+            return self.turbojpeg.encode(image, quality=self.jpeg_quality,
+                                         pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+        # The uint8 array is returned as-is: the broadcaster's bytes join reads it through
+        # the buffer protocol, so a tobytes() copy would only be thrown away
+        _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return buffer
+    
+    def publish_frame(self, i, frame_data):
+        """Merge one camera's latest frame into latest_frames; wake the broadcaster once every camera has reported"""
+        with self.frame_lock:
+            self.camera_frames[i] = frame_data
+            # Rebuilt rather than mutated, so readers holding the old dict never see it change
+            self.latest_frames = {f'cam{j}': frame for j, frame in enumerate(self.camera_frames)
+                                  if frame is not None}
+            
+            self.fresh_cameras.add(i)
+            if len(self.fresh_cameras) < len(self.pipelines):
+                return
+            self.fresh_cameras.clear()
+            if self.latest_frames:
+                self.frame_count += 1
+        
+        # Wake the broadcaster; it only sends when there is something new
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.new_frame_event.set)
+    
+    def write_recording(self, ring, rgb_writer, depth_writer, combined_writer):
+        """Write queued frames for one camera until a None sentinel arrives"""
+        # Side-by-side frame for the combined video, reused for every frame
+        combined_image = np.empty((480, 1280, 3), np.uint8)
+        
+        writers = {name: writer for name, writer in [
+            ('rgb.mp4', rgb_writer),
+            ('depth.mp4', depth_writer),
+            ('combined.mp4', combined_writer)
+        ] if writer}
+        
+        while True:
+            slot = ring.ready_slots.get()
+            if slot is None:
+                break
+            
+            color_image, depth_colormap = slot
+            
+            # Combined side-by-side frame
+            # (both streams are configured at 640x480, and the ring slots have that shape)
+            if 'combined.mp4' in writers:
+                combined_image[:, :640] = color_image
+                combined_image[:, 640:] = depth_colormap
+            
+            frames = {
+                'rgb.mp4': color_image,
+                'depth.mp4': depth_colormap,
+                'combined.mp4': combined_image
+            }
+            for name, writer in list(writers.items()):
+                while writer:
+                    try:
+                        writer.write(frames[name])
+                        break
+                    except OSError as e:
+                        # An ffmpeg encoder that died (e.g. out of NVENC sessions, which the
+                        # one-session startup probe can't see) is replaced by a software one;
+                        # anything else only loses its own file
+                        try:
+                            writer.release()
+                        except Exception:
+                            pass
+                        writer = self.open_fallback_writer(writer) if isinstance(writer, FFmpegWriter) else None
+                        if writer:
+                            print(f"Recording {name} failed ({e}), restarted with a software encoder")
+                            writers[name] = writer
+                        else:
+                            print(f"Recording {name} failed, no more frames will be written to it: {e}")
+                            del writers[name]
+            
+            # Return the slot to the ring for reuse
+            ring.free_slots.put(slot)
+        
+        # Release here rather than in finish_recording: this thread may have swapped in fallbacks
+        for name, writer in writers.items():
+            try:
+                writer.release()
+            except Exception as e:
+                print(f"  Release error for {name}: {e}")
+    
+    def write_depth_raw(self, ring, depth_npy_writer):
+        """Append queued raw depth frames for one camera to depth.npy until a None sentinel arrives"""
+        while True:
+            slot = ring.ready_slots.get()
+            if slot is None:
+                break
             
-            # Store latest frames if we got any
-            if frame_data:
-                with self.frame_lock:
-                    self.latest_frames = frame_data
-                    self.frame_count += 1
+            if depth_npy_writer:
+                try:
+                    depth_npy_writer.write(slot[0])
+                except OSError as e:
+                    print(f"Recording depth.npy failed, no more frames will be written to it: {e}")
+                    depth_npy_writer = None
             
-            # Small delay to prevent CPU overload
-            time.sleep(1/60)  # 60 FPS max
+            ring.free_slots.put(slot)
+        
+        if depth_npy_writer:
+            depth_npy_writer.release()
+    
+    def open_fallback_writer(self, writer):
+        """Reopen a dead FFmpegWriter's file with libx264, or with mp4v if x264 was the one that died"""
+        # The dead encoder's file has no index yet, so starting it over loses nothing usable
+        if writer.encoder != 'libx264':
+            return FFmpegWriter(writer.filename, 'libx264', writer.fps, writer.size)
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        return cv2.VideoWriter(writer.filename, fourcc, writer.fps, writer.size)
+    
+    def ffmpeg_encoder_works(self, encoder):
+        """Encode one test frame to check the GPU/driver behind an ffmpeg encoder is usable"""
+        input_args, output_args = FFMPEG_ENCODER_ARGS[encoder]
+        command = ['ffmpeg', '-loglevel', 'error'] + input_args
+        command += ['-f', 'lavfi', '-i', 'color=size=640x480', '-frames:v', '1']
+        command += ['-c:v', encoder] + output_args + ['-f', 'null', '-']
+        try:
+            return subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  timeout=10).returncode == 0
+        except Exception:
+            return False
+    
+    def gstreamer_encoder_works(self, encoder):
+        """Open a throwaway GStreamer pipeline to check a hardware encoder element is usable"""
+        writer = cv2.VideoWriter(f"appsrc ! videoconvert ! {encoder} ! fakesink",
+                                 cv2.CAP_GSTREAMER, 0, 30.0, (640, 480))
+        works = writer.isOpened()
+        writer.release()
+        return works
+    
+    def select_video_encoder(self):
+        """Probe the encoders once at startup, so start_record never blocks the event loop on it"""
+        candidates = self.hw_encoders if self.has_gstreamer else []
+        candidates = candidates + (self.ffmpeg_encoders if self.has_ffmpeg else [])
+        
+        for encoder in candidates:
+            if encoder in self.ffmpeg_encoders:
+                if self.ffmpeg_encoder_works(encoder):
+                    print(f"Video encoder: {encoder} (ffmpeg)")
+                    self.video_encoder = encoder
+                    return
+            elif self.gstreamer_encoder_works(encoder):
+                print(f"Video encoder: {encoder} (GStreamer)")
+                self.video_encoder = encoder
+                return
+        
+        print("Video encoder: mp4v (software)")
+        self.video_encoder = 'mp4v'
+    
+    def open_video_writer(self, filename, size, fps=30.0):
+        """Open a video writer with the encoder chosen by select_video_encoder"""
+        encoder = self.video_encoder
+        if encoder in self.ffmpeg_encoders:
+            writer = FFmpegWriter(filename, encoder, fps, size)
+            if writer.isOpened():
+                return writer
+            writer.release()
+        elif encoder not in (None, 'mp4v'):
+            gst_pipeline = (f"appsrc ! videoconvert ! {encoder} ! h264parse ! mp4mux ! "
+                            f"filesink location={filename}")
+            writer = cv2.VideoWriter(gst_pipeline, cv2.CAP_GSTREAMER, 0, fps, size)
+            if writer.isOpened():
+                return writer
+            writer.release()
+        
+        if encoder != 'mp4v':
+            print(f"Video encoder {encoder} failed for {filename}, using mp4v")
+        
+        # Software fallback with better codec compatibility
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # More compatible than avc1
+        return cv2.VideoWriter(filename, fourcc, fps, size)
     
     def start_recording(self):
         """Start video recording for all cameras with session-based structure"""
@@ -262,13 +618,22 @@ class GridCameraRealSenseServer:
         # Create session folder
         session_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.session_dir = os.path.join(self.recordings_dir, f"session_{session_timestamp}")
-        os.makedirs(self.session_dir, exist_ok=True)
+        # A session stopped within the same second may still be finalizing into its folder,
+        # so never reuse one
+        suffix = 1
+        while os.path.exists(self.session_dir):
+            self.session_dir = os.path.join(self.recordings_dir, f"session_{session_timestamp}_{suffix}")
+            suffix += 1
+        os.makedirs(self.session_dir)
         
         self.video_writers = []
         self.rgb_writers = []
-        self.depth_arrays = []
+        self.depth_npy_writers = []
         self.depth_writers = []
         self.camera_dirs = []
+        self.record_rings = []
+        self.depth_raw_rings = []
+        self.record_threads = []
         
         # Create audio folder
         audio_dir = os.path.join(self.session_dir, "audio_system")
@@ -287,26 +652,50 @@ class GridCameraRealSenseServer:
             combined_file = os.path.join(camera_dir, "combined.mp4")
             depth_file = os.path.join(camera_dir, "depth.mp4")
             
-            # RGB video writer with better codec compatibility
-            rgb_fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # More compatible than avc1
-            rgb_writer = cv2.VideoWriter(rgb_file, rgb_fourcc, 30.0, (640, 480))
+            # RGB video writer
+            rgb_writer = self.open_video_writer(rgb_file, (640, 480))
             
             # Combined (side-by-side) video writer  
-            combined_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            combined_writer = cv2.VideoWriter(combined_file, combined_fourcc, 30.0, (1280, 480))
+            combined_writer = self.open_video_writer(combined_file, (1280, 480))
             
             # Depth video writer - save depth colormap as video
-            depth_fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            depth_writer = cv2.VideoWriter(depth_file, depth_fourcc, 30.0, (640, 480))
-            
-            # Keep empty array for compatibility (we'll save raw depth separately)
-            depth_array = []
+            depth_writer = self.open_video_writer(depth_file, (640, 480))
             
             self.rgb_writers.append(rgb_writer)
             self.video_writers.append(combined_writer)  # Keep for compatibility
-            self.depth_arrays.append(depth_array)
             self.depth_writers.append(depth_writer)
             
+            # Ring of reusable frame slots shared with this camera's writer thread
+            ring = RecordRing(self.record_ring_size, [
+                ((480, 640, 3), np.uint8),  # Color
+                ((480, 640, 3), np.uint8)   # Depth colormap
+            ])
+            self.record_rings.append(ring)
+            
+            record_thread = Thread(
+                target=self.write_recording,
+                args=(ring, rgb_writer, depth_writer, combined_writer),
+                daemon=True
+            )
+            record_thread.start()
+            self.record_threads.append(record_thread)
+            
+            # Raw depth writer - z16 frames streamed straight to disk on a separate ring and thread
+            if self.record_depth_raw:
+                depth_npy_writer = DepthNpyWriter(os.path.join(camera_dir, "depth.npy"), (480, 640))
+                self.depth_npy_writers.append(depth_npy_writer)
+                
+                depth_raw_ring = RecordRing(self.record_ring_size, [((480, 640), np.uint16)])
+                self.depth_raw_rings.append(depth_raw_ring)
+                
+                depth_raw_thread = Thread(
+                    target=self.write_depth_raw,
+                    args=(depth_raw_ring, depth_npy_writer),
+                    daemon=True
+                )
+                depth_raw_thread.start()
+                self.record_threads.append(depth_raw_thread)
+            
             print(f"  Camera {serial}: {camera_dir}")
         
         self.is_recording = True
@@ -315,29 +704,46 @@ class GridCameraRealSenseServer:
         return [self.session_dir]
     
     def stop_recording(self):
-        """Stop video recording for all cameras and save depth arrays"""
+        """Stop video recording for all cameras; files are finalized on a background thread"""
         if not self.is_recording:
             return
         
         self.is_recording = False
         
-        # Release video writers
-        for i, writer in enumerate(self.video_writers):
-            if writer:
-                writer.release()
+        # Hand this session's state to a finishing thread and reset for the next session,
+        # so draining writers, release() and the WAV write never block the event loop
+        finish_thread = Thread(
+            target=self.finish_recording,
+            args=(self.record_rings + self.depth_raw_rings, self.record_threads,
+                  self.audio_data, self.audio_file, self.session_dir),
+            daemon=True
+        )
+        finish_thread.start()
+        self.finish_threads.append(finish_thread)
         
-        for i, writer in enumerate(self.rgb_writers):
-            if writer:
-                writer.release()
-        
-        for i, writer in enumerate(self.depth_writers):
-            if writer:
-                writer.release()
+        # Clear arrays
+        self.video_writers = []
+        self.rgb_writers = []
+        self.depth_npy_writers = []
+        self.depth_writers = []
+        self.camera_dirs = []
+        self.record_rings = []
+        self.depth_raw_rings = []
+        self.record_threads = []
+        self.audio_data = []
+    
+    def finish_recording(self, record_rings, record_threads, audio_data, audio_file, session_dir):
+        """Drain writer threads (which release their writers) and save audio for a stopped session"""
+        # Let the writer threads drain their queued frames and close their files
+        for ring in record_rings:
+            ring.ready_slots.put(None)
+        for record_thread in record_threads:
+            record_thread.join()
         
         # Save audio file
-        if self.audio_data and self.audio_file:
+        if audio_data and audio_file:
             try:
-                audio_array = np.array(self.audio_data, dtype=np.float32)
+                audio_array = np.array(audio_data, dtype=np.float32)
                 # Reshape for stereo
                 if len(audio_array) % 2 == 0:
                     audio_array = audio_array.reshape(-1, 2)
@@ -345,7 +751,7 @@ class GridCameraRealSenseServer:
                     audio_array = audio_array[:-1].reshape(-1, 2)
                 
                 # Save as WAV
-                with wave.open(self.audio_file, 'w') as wav_file:
+                with wave.open(audio_file, 'w') as wav_file:
                     wav_file.setnchannels(self.audio_channels)
                     wav_file.setsampwidth(2)  # 16-bit
                     wav_file.setframerate(self.audio_sample_rate)
@@ -353,22 +759,16 @@ class GridCameraRealSenseServer:
                     audio_int16 = (audio_array * 32767).astype(np.int16)
                     wav_file.writeframes(audio_int16.tobytes())
                 
-                print(f"  Saved audio: {self.audio_file} ({len(self.audio_data)} samples)")
+                print(f"  Saved audio: {audio_file} ({len(audio_data)} samples)")
             except Exception as e:
                 print(f"  Audio save error: {e}")
         
-        # Clear arrays
-        self.video_writers = []
-        self.rgb_writers = []
-        self.depth_arrays = []
-        self.depth_writers = []
-        self.camera_dirs = []
-        self.audio_data = []
-        
-        print(f"Recording session completed: {self.session_dir}")
+        print(f"Recording session completed: {session_dir}")
         print("Files saved per camera:")
         print("  - rgb.mp4 (color video)")  
         print("  - depth.mp4 (depth colormap video)")
+        if self.record_depth_raw:
+            print("  - depth.npy (raw z16 depth frames)")
         print("  - combined.mp4 (side-by-side color+depth)")
     
     async def handle_client(self, websocket):
@@ -394,12 +794,25 @@ class GridCameraRealSenseServer:
                         'status': 'recording_stopped'
                     }))
                     
+                elif data.get('action') == 'subscribe_depth_raw':
+                    self.depth_raw_clients.add(websocket)
+                    await websocket.send(json.dumps({
+                        'status': 'depth_raw_subscribed'
+                    }))
+                    
+                elif data.get('action') == 'unsubscribe_depth_raw':
+                    self.depth_raw_clients.discard(websocket)
+                    await websocket.send(json.dumps({
+                        'status': 'depth_raw_unsubscribed'
+                    }))
+                    
         except websockets.exceptions.ConnectionClosed:
             pass
         except Exception as e:
             print(f"Client error: {e}")
         finally:
             self.connected_clients.remove(websocket)
+            self.depth_raw_clients.discard(websocket)
             print(f"Client disconnected: {client_addr}")
     
     async def broadcast_frames(self):
@@ -407,21 +820,30 @@ class GridCameraRealSenseServer:
         print("Starting frame broadcast...")
         
         while self.is_streaming:
-            if self.connected_clients and self.latest_frames:
-                with self.frame_lock:
-                    frames = self.latest_frames.copy()
-                
-                # Calculate sync difference between cameras
-                timestamps = [frame['timestamp'] for frame in frames.values()]
-                sync_diff = (max(timestamps) - min(timestamps)) * 1000 if len(timestamps) > 1 else 0.0
-                
+            # Wait for the capture thread to publish new frames instead of polling
+            try:
+                await asyncio.wait_for(self.new_frame_event.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                continue
+            self.new_frame_event.clear()
+            
+            if not self.connected_clients:
+                continue
+            
+            # publish_frame swaps in a new dict rather than mutating it, so the current
+            # reference can be read without the lock or a copy
+            frames = self.latest_frames
+            
+            # Frames captured before the first client connected were not encoded
+            if frames and all(frame['color_jpeg'] is not None for frame in frames.values()):
                 # Get audio data if available
                 audio_data = None
                 if not self.audio_queue.empty():
                     try:
                         audio_chunk = self.audio_queue.get_nowait()
-                        # Convert to simple amplitude for visualization
-                        audio_amplitude = np.max(np.abs(audio_chunk)) if len(audio_chunk) > 0 else 0.0
+                        # Convert to simple amplitude for visualization; peak from min/max
+                        # avoids the temporary array np.abs would allocate
+                        audio_amplitude = max(audio_chunk.max(), -audio_chunk.min()) if len(audio_chunk) > 0 else 0.0
                         audio_data = {
                             'amplitude': float(audio_amplitude),
                             'timestamp': time.time()
@@ -429,51 +851,120 @@ class GridCameraRealSenseServer:
                     except:
                         pass
                 
-                # Create message with camera grid data
+                # Create message header with camera grid data
                 message = {
                     'is_recording': self.is_recording,
                     'frame_number': self.frame_count,
-                    'sync_diff': sync_diff,
+                    'sync_diff': 0.0,  # Filled in below from the camera timestamps
                     'num_cameras': len(frames),
                     'cameras': [],
                     'audio': audio_data
                 }
                 
-                # Add each camera's RGB + Depth data
+                # Add each camera's RGB + Depth data; JPEG bytes follow the header in order
+                # and the sync spread is tracked in the same pass
+                jpegs = []
+                first_timestamp = last_timestamp = None
                 for i, (cam_key, frame_data) in enumerate(frames.items()):
                     camera_data = {
                         'index': i,
                         'serial': frame_data['serial'],
-                        'color': frame_data['color_encoded'],
-                        'depth': frame_data['depth_encoded'],
+                        'color_size': len(frame_data['color_jpeg']),
+                        'depth_size': len(frame_data['depth_jpeg']),
                         'timestamp': frame_data['timestamp']
                     }
                     message['cameras'].append(camera_data)
+                    jpegs.append(frame_data['color_jpeg'])
+                    jpegs.append(frame_data['depth_jpeg'])
+                    
+                    timestamp = frame_data['timestamp']
+                    if first_timestamp is None or timestamp < first_timestamp:
+                        first_timestamp = timestamp
+                    if last_timestamp is None or timestamp > last_timestamp:
+                        last_timestamp = timestamp
                 
-                # Send to all clients
-                disconnected = set()
-                for client in self.connected_clients:
-                    try:
-                        await client.send(json.dumps(message))
-                    except:
-                        disconnected.add(client)
+                # Calculate sync difference between cameras
+                message['sync_diff'] = (last_timestamp - first_timestamp) / 1e6  # ns -> ms
                 
-                # Remove disconnected clients
-                self.connected_clients -= disconnected
-            
-            await asyncio.sleep(1/30)  # ~30 FPS
+                payload = self.build_payload(message, jpegs)
+                
+                # Let slow clients drain instead of piling more frames into their buffers;
+                # raw depth subscribers may hold one more raw frame set, which JPEG quality can't shrink
+                depth_raws = [frame_data['depth_raw'] for frame_data in frames.values()]
+                raw_backlog = self.max_client_backlog + sum(len(depth_raw) for depth_raw in depth_raws
+                                                            if depth_raw is not None)
+                backlogs = {client: client.transport.get_write_buffer_size()
+                            for client in self.connected_clients if client.transport is not None}
+                backlogged = {client for client, backlog in backlogs.items()
+                              if backlog > (raw_backlog if client in self.depth_raw_clients
+                                            else self.max_client_backlog)}
+                active_clients = self.connected_clients - backlogged
+                
+                # Encode cheaper previews while preview clients fall behind, judged on a moving
+                # average so a single slow send doesn't change the quality
+                preview_backlog = max((backlog for client, backlog in backlogs.items()
+                                       if client not in self.depth_raw_clients), default=0)
+                self.preview_backlog += 0.1 * (preview_backlog - self.preview_backlog)
+                now = time.monotonic()
+                if now - self.quality_adjusted_at >= 1.0:
+                    self.quality_adjusted_at = now
+                    if self.preview_backlog > self.max_client_backlog:
+                        self.jpeg_quality = max(self.min_preview_quality, self.jpeg_quality - 10)
+                    elif self.preview_backlog < self.max_client_backlog / 4:
+                        self.jpeg_quality = min(self.preview_quality, self.jpeg_quality + 5)
+                
+                # Subscribers to raw depth get the same frame with each camera's z16 bytes appended
+                raw_clients = self.depth_raw_clients & active_clients
+                if raw_clients and all(depth_raw is not None for depth_raw in depth_raws):
+                    raw_message = dict(message, cameras=[
+                        dict(camera_data, depth_raw_size=len(depth_raw))
+                        for camera_data, depth_raw in zip(message['cameras'], depth_raws)
+                    ])
+                    websockets.broadcast(raw_clients, self.build_payload(raw_message, jpegs + depth_raws))
+                    clients = active_clients - raw_clients
+                else:
+                    clients = active_clients
+                
+                # Send the same frame to all clients; closed connections are skipped and
+                # removed by handle_client when they finish
+                websockets.broadcast(clients, payload)
+    
+    def build_payload(self, message, segments):
+        """Binary frame: 4-byte big-endian header length, JSON header, then the raw segments"""
+        header = orjson.dumps(message) if orjson is not None else json.dumps(message).encode('utf-8')
+        return b''.join([len(header).to_bytes(4, 'big'), header] + segments)
     
     async def start_server(self, host='localhost', port=8765):
         """Start the WebSocket server"""
         print(f"Starting Grid Camera WebSocket server on {host}:{port}")
         
+        # Optimized OpenCV kernels with a small worker pool per call
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(2)
+        
+        # Keep capture/encode threads (inherited from here) off CPU 0, which usually
+        # services the USB interrupts
+        if hasattr(os, 'sched_setaffinity'):
+            cpus = os.sched_getaffinity(0) - {0}
+            if len(cpus) >= 2:
+                os.sched_setaffinity(0, cpus)
+        
+        # Capture thread signals new frames to the broadcaster on this loop
+        self.loop = asyncio.get_running_loop()
+        self.new_frame_event = asyncio.Event()
+        
         # Initialize cameras
         self.initialize_cameras()
         self.is_streaming = True
         
-        # Start frame capture thread
-        capture_thread = Thread(target=self.capture_frames, daemon=True)
-        capture_thread.start()
+        # Encoder probes can take seconds; done here, before any client is being served
+        self.select_video_encoder()
+        
+        # Start one frame capture thread per camera
+        self.camera_frames = [None] * len(self.pipelines)
+        for i in range(len(self.pipelines)):
+            capture_thread = Thread(target=self.capture_frames, args=(i,), daemon=True)
+            capture_thread.start()
         
         # Start audio capture thread
         audio_thread = Thread(target=self.capture_audio, daemon=True)
@@ -494,6 +985,10 @@ class GridCameraRealSenseServer:
         self.is_audio_streaming = False
         self.stop_recording()
         
+        # Daemon threads die with the process, so wait for recordings to be finalized
+        for finish_thread in self.finish_threads:
+            finish_thread.join()
+        
         for pipeline in self.pipelines:
             try:
                 pipeline.stop()
@@ -515,4 +1010,6 @@ async def main():
         server.cleanup()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())
\ No newline at end of file
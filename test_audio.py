@@ -74,38 +74,46 @@ def test_audio_recording(device_id=None, duration=5, filename="test_audio.wav"):
             print(f"Device only supports {channels} channel(s), adjusting...")
     
     try:
-        # Record audio
-        audio_data = sd.rec(int(duration * sample_rate), 
-                           samplerate=sample_rate, 
-                           channels=channels, 
-                           dtype=np.float32,
-                           device=device_id)
+        peak = 0
         
-        print("Recording... (make some noise!)")
-        sd.wait()
+        # Save as WAV file, written block by block while recording
+        with wave.open(filename, 'wb') as wav_file:
+            wav_file.setnchannels(channels)
+            wav_file.setsampwidth(2)  # 16-bit
+            wav_file.setframerate(sample_rate)
+            
+            def callback(indata, frames, time, status):
+                """Append each recorded int16 block to the file and track the peak"""
+                nonlocal peak
+                if status:
+                    print(f"Audio status: {status}")
+                wav_file.writeframesraw(indata.tobytes())
+                # Peak from min/max; np.abs would overflow on -32768 in int16
+                peak = max(peak, int(indata.max()), -int(indata.min()))
+            
+            # Record audio straight into 16-bit samples, the format the WAV file stores
+            with sd.InputStream(samplerate=sample_rate,
+                                channels=channels,
+                                dtype=np.int16,
+                                device=device_id,
+                                callback=callback):
+                print("Recording... (make some noise!)")
+                sd.sleep(int(duration * 1000))
         
-        max_amplitude = np.max(np.abs(audio_data))
+        max_amplitude = peak / 32768
         print(f"Recording complete. Max amplitude: {max_amplitude:.3f}")
         
         if max_amplitude < 0.001:
             print("WARNING: Very low audio level detected. Check microphone and volume settings.")
         
-        # Save as WAV file
-        with wave.open(filename, 'w') as wav_file:
-            wav_file.setnchannels(channels)
-            wav_file.setsampwidth(2)  # 16-bit
-            wav_file.setframerate(sample_rate)
-            
-            # Convert float32 to int16
-            audio_int16 = (audio_data * 32767).astype(np.int16)
-            wav_file.writeframes(audio_int16.tobytes())
-        
         print(f"Audio saved to: {filename}")
         
         # Test playback
         print("\nTesting playback...")
         try:
-            sd.play(audio_data, sample_rate)
+            with wave.open(filename, 'rb') as wav_file:
+                audio_data = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+            sd.play(audio_data.reshape(-1, channels), sample_rate)
             sd.wait()
             print("Playback complete")
         except Exception as e:
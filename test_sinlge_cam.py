@@ -5,6 +5,57 @@
 import pyrealsense2 as rs
 import numpy as np
 import cv2
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Optimized OpenCV kernels with a small worker pool; more threads only add sync
+# overhead on 640x480 images
+cv2.setUseOptimized(True)
+cv2.setNumThreads(2)
+
+# Keep processing off CPU 0, which usually services the USB interrupts
+if hasattr(os, 'sched_setaffinity'):
+    cpus = os.sched_getaffinity(0) - {0}
+    if len(cpus) >= 2:
+        os.sched_setaffinity(0, cpus)
+
+# Stream resolution shared by both sensors
+WIDTH, HEIGHT, FPS = 640, 480, 30
+
+WINDOW_NAME = 'RealSense'
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 1
+FONT_THICKNESS = 2
+TEXT_COLOR = (0, 255, 0)
+TEXT_ORIGIN = (10, 30)
+
+def colorize_depth(depth_image, depth_u8, out):
+    """Apply colormap on depth image (image must be converted to 8-bit per pixel first)"""
+    cv2.convertScaleAbs(depth_image, depth_u8, alpha=0.03)
+    cv2.applyColorMap(depth_u8, cv2.COLORMAP_JET, out)
+
+def render_text_tile(text):
+    """Rasterize text once into a color tile + mask that can be blitted every frame"""
+    (width, height), baseline = cv2.getTextSize(text, FONT, FONT_SCALE, FONT_THICKNESS)
+    pad = FONT_THICKNESS
+    tile = np.zeros((height + baseline + 2 * pad, width + 2 * pad, 3), np.uint8)
+    cv2.putText(tile, text, (pad, height + pad), FONT, FONT_SCALE, TEXT_COLOR, FONT_THICKNESS)
+    # Pen advance as putText applies it when the text is followed by more glyphs
+    advance = (cv2.getTextSize(text + "0", FONT, FONT_SCALE, FONT_THICKNESS)[0][0]
+               - cv2.getTextSize("0", FONT, FONT_SCALE, FONT_THICKNESS)[0][0])
+    return tile, tile.any(axis=2, keepdims=True), advance, height + pad, pad
+
+def blit_text(image, tiles, origin):
+    """Copy pre-rendered text tiles into image, left to right from the baseline origin"""
+    x, y = origin
+    for tile, mask, advance, ascent, pad in tiles:
+        h, w = tile.shape[:2]
+        np.copyto(image[y - ascent:y - ascent + h, x - pad:x - pad + w], tile, where=mask)
+        x += advance
+
+# Only the frame number changes, so the label and the digits are rendered once
+FRAME_LABEL_TILE = render_text_tile("Frame: ")
+DIGIT_TILES = {digit: render_text_tile(digit) for digit in "0123456789"}
 
 # Configure depth and color streams
 pipeline = rs.pipeline()
@@ -19,36 +70,64 @@ device_product_line = str(device.get_info(rs.camera_info.product_line))
 print(f"Found device: {device_product_line}")
 
 found_rgb = False
+info_name = rs.camera_info.name
 for s in device.sensors:
-    if s.get_info(rs.camera_info.name) == 'RGB Camera':
+    if s.get_info(info_name) == 'RGB Camera':
         found_rgb = True
         break
 if not found_rgb:
     print("The demo requires Depth camera with Color sensor")
     exit(0)
 
-config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+config.enable_stream(rs.stream.depth, WIDTH, HEIGHT, rs.format.z16, FPS)
+config.enable_stream(rs.stream.color, WIDTH, HEIGHT, rs.format.bgr8, FPS)
 
-# Start streaming
-pipeline.start(config)
+# Start streaming into a single-slot frame queue so capture runs on librealsense's
+# thread and the render loop below only ever sees the newest frameset; older ones
+# are dropped instead of building up latency
+frame_queue = rs.frame_queue(1, keep_frames=False)
+pipeline.start(config, frame_queue)
 print("Pipeline started successfully!")
 print("Press ESC to exit, 's' to save frame")
 
 frame_count = 0
 timeout_count = 0
+idle_waits = 0  # Consecutive 100 ms waits without a frame
+
+# Per-frame buffers, allocated once and reused by every iteration
+depth_u8 = np.empty((HEIGHT, WIDTH), np.uint8)
+images = np.empty((HEIGHT, 2 * WIDTH, 3), np.uint8)
+color_half = images[:, :WIDTH]   # Views into the side-by-side composite
+depth_half = images[:, WIDTH:]
+
+# Worker for the depth colormap, which runs while the main thread composes the color half
+depth_worker = ThreadPoolExecutor(max_workers=1)
+
+# Snapshot saves are encoded off the display loop; extra presses are dropped while busy
+save_worker = ThreadPoolExecutor(max_workers=1)
+pending_saves = []
+MAX_PENDING_SAVES = 4
+
+cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_AUTOSIZE)
 
 try:
     while True:
-        # Wait for frames with timeout handling
-        try:
-            frames = pipeline.wait_for_frames(timeout_ms=1000)
-        except RuntimeError as e:
-            timeout_count += 1
-            if timeout_count % 10 == 1:  # Print every 10th timeout
-                print(f"Frame timeout #{timeout_count}: {e}")
+        # Sleep until the next frameset arrives instead of spinning on the GUI; only if
+        # none shows up for a while pump the window once to stay responsive
+        got_frame, frames = frame_queue.try_wait_for_frame(100)
+        if not got_frame:
+            # A full second without frames counts as one timeout (usually the USB cable)
+            idle_waits += 1
+            if idle_waits % 10 == 0:
+                timeout_count += 1
+                if timeout_count % 10 == 1:  # Print every 10th timeout
+                    print(f"Frame timeout #{timeout_count}: no frame within 1000ms")
+            if cv2.waitKey(1) & 0xFF == 27:  # ESC
+                break
             continue
-            
+        idle_waits = 0
+
+        frames = frames.as_frameset()
         depth_frame = frames.get_depth_frame()
         color_frame = frames.get_color_frame()
         if not depth_frame or not color_frame:
@@ -56,41 +135,52 @@ try:
 
         frame_count += 1
         
-        # Convert images to numpy arrays
-        depth_image = np.asanyarray(depth_frame.get_data())
-        color_image = np.asanyarray(color_frame.get_data())
+        # Zero-copy numpy views over the frame buffers (valid while the frame is alive)
+        depth_image = np.frombuffer(depth_frame.get_data(), dtype=np.uint16,
+                                    count=HEIGHT * WIDTH).reshape(HEIGHT, WIDTH)
+        color_image = np.frombuffer(color_frame.get_data(), dtype=np.uint8,
+                                    count=HEIGHT * WIDTH * 3).reshape(HEIGHT, WIDTH, 3)
 
-        # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-        depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
+        # Colorize depth straight into the right half of the composite on the worker;
+        # OpenCV releases the GIL, so it overlaps with the color half below
+        depth_done = depth_worker.submit(colorize_depth, depth_image, depth_u8, depth_half)
 
-        depth_colormap_dim = depth_colormap.shape
-        color_colormap_dim = color_image.shape
+        # Both streams share one resolution, so the color half is a single copy
+        color_half[:] = color_image
 
-        # If depth and color resolutions are different, resize color image to match depth image for display
-        if depth_colormap_dim != color_colormap_dim:
-            resized_color_image = cv2.resize(color_image, dsize=(depth_colormap_dim[1], depth_colormap_dim[0]), interpolation=cv2.INTER_AREA)
-            images = np.hstack((resized_color_image, depth_colormap))
-        else:
-            images = np.hstack((color_image, depth_colormap))
+        # Add frame counter (drawn inside the color half)
+        blit_text(images, [FRAME_LABEL_TILE] + [DIGIT_TILES[d] for d in str(frame_count)],
+                  TEXT_ORIGIN)
 
-        # Add frame counter
-        cv2.putText(images, f"Frame: {frame_count}", (10, 30), 
-                    cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+        depth_done.result()
 
         # Show images
-        cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
-        cv2.imshow('RealSense', images)
+        cv2.imshow(WINDOW_NAME, images)
         
-        key = cv2.waitKey(1) & 0xFF
+        # pollKey pumps GUI events without waitKey's wait; only every other frame pays for it
+        key = (cv2.pollKey() if frame_count & 1 else cv2.waitKey(1)) & 0xFF
         if key == 27:  # ESC
             break
         elif key == ord('s'):
             filename = f"frame_{frame_count}.png"
-            cv2.imwrite(filename, color_image)
-            print(f"Saved {filename}")
+            pending_saves = [save for save in pending_saves if not save.done()]
+            if len(pending_saves) < MAX_PENDING_SAVES:
+                # Copy: the frame buffer goes back to librealsense on the next iteration
+                # Fastest zlib level: these are debug snapshots, encode time matters more than size
+                pending_saves.append(save_worker.submit(cv2.imwrite, filename, color_image.copy(),
+                                                        [cv2.IMWRITE_PNG_COMPRESSION, 1]))
+                print(f"Saving {filename}")
+            else:
+                print(f"Skipped {filename}, previous saves still in progress")
+
+        # Stop once the window has been closed rather than keep rendering for nobody
+        if cv2.getWindowProperty(WINDOW_NAME, cv2.WND_PROP_VISIBLE) < 1:
+            break
 
 finally:
     # Stop streaming
+    depth_worker.shutdown()
+    save_worker.shutdown()  # Waits for queued snapshots to finish writing
     pipeline.stop()
     cv2.destroyAllWindows()
     print(f"\nTotal frames: {frame_count}, Timeouts: {timeout_count}")
\ No newline at end of file